@@ -1,8 +1,18 @@
-from typing import List
+from typing import (Dict, Iterable, Iterator, List, Optional, Pattern, TextIO,
+                    Tuple)
 from pathlib import Path
-import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import lxml.etree as ET
+    LXML = True
+except ImportError:     # lxml is optional, stdlib parser works the same here
+    import xml.etree.ElementTree as ET
+    LXML = False
 import shutil
-import csv
+import os
+import errno
+import re
+import functools
 import argparse
 
 """
@@ -41,7 +51,16 @@ where phase is either 1 or 2, depending on the phase the user wishes to run.
 
 """
 
-def remove_systematic_errors(source: Path, target: Path) -> None:
+# Placeholder <x id="i"/> as mistranslated by google translate, and its fix
+_BROKEN_PLACEHOLDER = re.compile(r'<x id = "(\d+)" />')
+_FIXED_PLACEHOLDER = r'<x id="\1"/>'
+# Escapes done by csv.writer when quoting is csv.QUOTE_NONE
+_CSV_ESCAPES = str.maketrans({'\\': '\\\\', '|': '\\|', 
+                              '\r': '\\\r', '\n': '\\\n'})
+# Amount of characters read at once when fixing the placeholders
+_CHUNK_SIZE = 1 << 24
+
+def fix_rows(lines: Iterable[str]) -> Iterator[str]:
     """
     Google translate does some systematic errors in its translations.
     Mainly a very commonly used placeholder format <x id="i"/> gets
@@ -49,26 +68,75 @@ def remove_systematic_errors(source: Path, target: Path) -> None:
     it is used within a single string which starts with 1. I.E. we can have i 
     values from 1 to 5 within a single string, but can't have say 1 and 4.
 
+    Yields the lines with these errors corrected. The fix is a pure textual 
+    substitution, so the lines aren't parsed as csv and any piece of text 
+    works as a line, as long as no placeholder is split between two.
+    """
+    for line in lines:
+        yield _BROKEN_PLACEHOLDER.sub(_FIXED_PLACEHOLDER, line)
+
+def _read_line_chunks(file: TextIO) -> Iterator[str]:
+    """
+    Yields the contents of file in large chunks of complete lines. Since 
+    placeholders never span lines, the chunks can be fixed one at a time.
+    """
+    tail = ''
+    while True:
+        chunk = file.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        # The last incomplete line is left for the next chunk
+        chunk = tail + chunk
+        end = chunk.rfind('\n') + 1
+        tail = chunk[end:]
+        if end:
+            yield chunk[:end]
+    if tail:
+        yield tail
+
+def remove_systematic_errors(source: Path, target: Path) -> None:
+    """
     Function opens the csv file at source, and a file at target and copies
-    rows from source to target and applies these error corrections.
+    the contents from source to target and applies the error corrections of
+    fix_rows. The file is handled in large chunks of complete lines to limit
+    memory use.
     """
-    with open(target, 'w', encoding='utf-8') as target_f:
-        with open(source, 'r', encoding='utf-8') as source_f:
-            writer = csv.writer(target_f, delimiter="|", quoting=csv.QUOTE_NONE, 
-            escapechar='\\', quotechar='')
-            reader = csv.reader(source_f, delimiter="|", quoting=csv.QUOTE_NONE, 
-            escapechar='\\', quotechar='')
+    # Line endings are kept as they are in source
+    with open(target, 'w', encoding='utf-8', newline='', 
+              buffering=1 << 20) as target_f:
+        with open(source, 'r', encoding='utf-8', newline='', 
+                  buffering=1 << 20) as source_f:
+            target_f.writelines(fix_rows(_read_line_chunks(source_f)))
 
-            for row in reader:
-                if len(row) == 7:
-                    i = 1
-                    while row[3].find('<x id = "{}" />'.format(i)) != -1:
-                        row[3] = row[3].replace('<x id = "{}" />'.format(i), 
-                                                    '<x id="{}"/>'.format(i))
-                        i += 1
 
-                writer.writerow(row)
+@functools.lru_cache(maxsize=1024)
+def _parse_glossary(glossary_str: str) -> Tuple[Dict[str, str], 
+                                                Optional[Pattern[str]]]:
+    """
+    Glossary is of form 'word1 = translation1; word2 = translation2; ...'
+    Returns the glossary as a dict and a single regex matching any of the
+    glossary words as a whole word (None if the glossary is empty). Longer 
+    words are tried first so multi-word entries win over their parts.
 
+    Many rows share the same glossary, so the results are cached. The 
+    returned dict must not be modified!
+    """
+    glossary = dict()
+    for pair in glossary_str.split(";"):
+        pair = [value.strip() for value in pair.split("=")]
+        if len(pair) == 2:
+            # Add both capitalised and uncapitalised versions to glossary dict
+            glossary[pair[0]] = pair[1]
+            glossary[pair[0].title()] = pair[1].title()
+        else:
+            pass    # Added since there were a few bad glossaries
+    glossary.pop("", None)  # An empty key would match everywhere
+    if not glossary:
+        return glossary, None
+
+    words = sorted(glossary, key=len, reverse=True)
+    alternatives = "|".join(map(re.escape, words))
+    return glossary, re.compile(r"(?<!\w)(?:" + alternatives + r")(?!\w)")
 
 def pretranslate_row(row_items: List[str]) -> List[str]:
     """
@@ -86,73 +154,141 @@ def pretranslate_row(row_items: List[str]) -> List[str]:
     Note: doesn't copy the old row, but modifies original. Use case doesn't 
     require copying.
     """
-    # Glossary can be None
-    if row_items[5] is None:
+    # Source can be empty or None and glossary can be None
+    if not row_items[2] or row_items[5] is None:
         row_items[3] = row_items[2]
         return row_items
 
-    # Glossary is of form 'word1 = translation1; word2 = translation2; ...'
-    glossary = dict()
-    for pair in row_items[5].split(";"):
-        pair = [value.strip() for value in pair.split("=")]
-        if len(pair) == 2:
-            # Add both capitalised and uncapitalised versions to glossary dict
-            glossary[pair[0]] = pair[1]
-            glossary[pair[0].title()] = pair[1].title()
-        else:
-            pass    # Added since there were a few bad glossaries
+    glossary, pattern = _parse_glossary(row_items[5])
+    if pattern is None:
+        row_items[3] = row_items[2]
+        return row_items
 
     # Set target equal to source, and replace words using glossary if possible
-    row_items[3] = " ".join([glossary[word] if word in glossary else word for   
-                                  word in row_items[2].split(" ")])
+    row_items[3] = pattern.sub(lambda match: glossary[match.group(0)], 
+                               row_items[2])
     return row_items
 
+# Spreadsheet namespace and the fully qualified tags used when parsing
+_SS_NS = "urn:schemas-microsoft-com:office:spreadsheet"
+_ROW_TAG = "{%s}Row" % _SS_NS
+_SHEET_TAG = "{%s}Worksheet" % _SS_NS
+_DATA_TAG = "{%s}Data" % _SS_NS
+
+# Under lxml the data of the cells in a row is found with one compiled XPath
+if LXML:
+    _CELL_DATA = ET.XPath("ss:Cell/ss:Data", namespaces={'ss': _SS_NS})
+else:
+    _CELL_DATA = None
+
+def _parse_xml(path: Path) -> Tuple[str, List[List[str]]]:
+    """
+    Parses the rows of a single xml file and pretranslates them. Returns the 
+    name of the file and the rows. Kept at module level so that it can be 
+    run in a worker process.
+    """
+    rows = []
+
+    # Stream the xml row by row instead of building the whole tree
+    row_index = 0
+    if LXML:
+        # Other elements are skipped already by lxml
+        context = ET.iterparse(str(path), events=("end",), 
+                               tag=(_ROW_TAG, _SHEET_TAG))
+    else:
+        context = ET.iterparse(str(path), events=("end",))
+    for _, elem in context:
+        if elem.tag == _SHEET_TAG:
+            break   # Only the first worksheet is used
+        if elem.tag != _ROW_TAG:
+            continue
+
+        # The first 8 rows are metadata!
+        if row_index >= 8:
+            if LXML:
+                row_items = [data.text for data in _CELL_DATA(elem)]
+            else:
+                # Same as the XPath, only the Data children of the cells
+                row_items = [data.text for cell in elem for data in cell 
+                             if data.tag == _DATA_TAG]
+            rows.append(pretranslate_row(row_items))
+        row_index += 1
+
+        # Free the already processed rows
+        elem.clear()
+        if LXML:    # Only lxml elements know their parent and siblings
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+    return path.parts[-1], rows
+
+def _format_row(row: List[Optional[str]]) -> str:
+    """
+    Formats a row the same way as csv.writer with delimiter '|', no quoting
+    (to conserve original quotes) and escapechar '\\' would, but without the 
+    overhead of the csv module.
+    """
+    return "|".join("" if value is None else value.translate(_CSV_ESCAPES) 
+                    for value in row) + "\r\n"
+
 def aggregate_xmls(paths: List[Path], target: Path) -> None:
     """
     Files are opened and the data from the rows is aggregated to a single .csv
     file. Some additional pretranslation processing has also been added.
+    The files are parsed in parallel, but written in the original order.
     """
-    with open(target, mode='w', encoding='utf-8') as aggregate:
-        # Settings more specific to conserve original quotes.
-        writer = csv.writer(aggregate, delimiter="|", quoting=csv.QUOTE_NONE, 
-        escapechar='\\', quotechar='')
-
-        # namespace to be used
-        ns = {'ss':"urn:schemas-microsoft-com:office:spreadsheet"}
-        for path in paths:
-            # Write the name of the file on a single row
-            writer.writerow([path.parts[-1]])
-
-            # Parse the xml
-            tree = ET.parse(path)
-            root = tree.getroot()
-            sheet = root.find("ss:Worksheet", ns)
-            table = sheet.find("ss:Table", ns)
-            # The first 8 rows are metadata!
-            for row in table.findall("ss:Row", ns)[8:]:
-                row_items = []
-                for cell in row:                        
-                    for data in cell:
-                        row_items.append(data.text)
-                writer.writerow(pretranslate_row(row_items))
-
-def move_xml_files(source: Path, target: Path) -> None:
+    with open(target, mode='w', encoding='utf-8', newline='', 
+              buffering=1 << 20) as aggregate:
+        with ProcessPoolExecutor() as executor:
+            for name, rows in executor.map(_parse_xml, paths):
+                # Write the name of the file on a single row, then its rows
+                aggregate.write(_format_row([name]))
+                aggregate.writelines(map(_format_row, rows))
+
+def move_xml_files(source: Path, target: Path) -> List[Path]:
     """
     Moves all xml files from source to target and empties old directory tree.
+    Returns the new paths of the moved files.
     Note: Does not preserve old directory tree structure, the new is flat!
     """
+    target.mkdir(parents=True, exist_ok=True)
     files = find_xml_files(source)
+    moved = []
     for file in files:
-        shutil.move(str(file), str(target))     # shutil requires str input!
+        destination = target / file.name
+        # os.replace would silently overwrite, shutil.move used to raise
+        if destination.exists():
+            raise FileExistsError(
+                "Destination path '{}' already exists".format(destination))
+        try:
+            os.replace(file, destination)   # Single rename on same filesystem
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+            shutil.move(str(file), str(destination))
+        moved.append(destination)
     shutil.rmtree(str(source))
     source.mkdir()
+    return moved
+
+def _scandir_recursive(path: str) -> Iterator[str]:
+    """
+    Yields the paths of all .xml files in the directory tree rooted at path.
+    Uses the cached DirEntry info so no extra stat calls are needed.
+    """
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scandir_recursive(entry.path)
+            elif (entry.name.endswith('.xml') and 
+                    entry.is_file(follow_symlinks=False)):
+                yield entry.path
 
 def find_xml_files(root: Path) -> List[Path]:
     """
     Find all files which end with .xml in the directory tree rooted at root
     """
-    files = list(root.glob('**/*.xml'))    # ** is for recursive
-    return files
+    return [Path(p) for p in _scandir_recursive(str(root))]
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Translation script')
@@ -168,10 +304,9 @@ if __name__ == "__main__":
         # todo is also emptied
         todo_path = Path('../todo')
         intermediate_path = Path('../intermediate')
-        move_xml_files(todo_path, intermediate_path)
+        files = move_xml_files(todo_path, intermediate_path)
 
         # Files should then be combined to a single .csv file
-        files = find_xml_files(Path('../intermediate'))
         aggregate_xmls(files, Path('../intermediate/intermediate.csv'))
 
     elif args.phase == 2:
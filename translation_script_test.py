@@ -1,6 +1,8 @@
 import pytest
+import errno
 import translation_script as ts
 from pathlib import Path
+from io import StringIO
 
 def test_find_xml_files(tmp_path: Path):
     # To run the test, we create a mock directory structure with 2 xml files
@@ -27,11 +29,45 @@ def test_move_xml_files(tmp_path: Path):
     new.mkdir()
 
     # Check values have been moved and the old directory removed
-    ts.move_xml_files(old, new)
+    paths = ts.move_xml_files(old, new)
+    assert sorted(paths) == [new / "test1.xml", new / "test2.xml"]
     assert (new / "test1.xml").is_file() and (new / "test2.xml").is_file()
     assert old.is_dir() == True
     assert ts.find_xml_files(old) == []
 
+def test_move_xml_files_duplicate_name(tmp_path: Path):
+    # Two files with the same name in different folders can't both be moved
+    old = tmp_path / "old"
+    for folder in ["a", "b"]:
+        (old / folder).mkdir(parents=True)
+        (old / folder / "x.xml").write_text(folder)
+    new = tmp_path / "new"
+    new.mkdir()
+    with pytest.raises(FileExistsError):
+        ts.move_xml_files(old, new)
+
+def test_move_xml_files_missing_target(tmp_path: Path):
+    old = tmp_path / "old"
+    old.mkdir()
+    (old / "test1.xml").write_text("test1")
+    new = tmp_path / "missing" / "new"
+    assert ts.move_xml_files(old, new) == [new / "test1.xml"]
+    assert (new / "test1.xml").read_text() == "test1"
+
+def test_move_xml_files_cross_device(tmp_path: Path, monkeypatch):
+    # os.replace can't move across filesystems, shutil.move is used instead
+    def replace(source, target):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+    monkeypatch.setattr(ts.os, 'replace', replace)
+    old = tmp_path / "old"
+    old.mkdir()
+    (old / "test1.xml").write_text("test1")
+    new = tmp_path / "new"
+    new.mkdir()
+    assert ts.move_xml_files(old, new) == [new / "test1.xml"]
+    assert (new / "test1.xml").read_text() == "test1"
+    assert ts.find_xml_files(old) == []
+
 def test_aggregate_xmls(tmp_path: Path):
     # Create a mock directory with the 2 test xmls
     data = tmp_path / "data"
@@ -56,6 +92,23 @@ def test_aggregate_xmls(tmp_path: Path):
         assert f.readline() == "test2.xml\n"
         assert f.readline() == "1|Test1|Test1|Testi|no context|Test1 = testi|\n"
 
+def test_parse_xml_cell_data_only(tmp_path: Path, monkeypatch):
+    # Other children of a cell than Data, e.g. NamedCell, are skipped
+    ns = 'xmlns="urn:schemas-microsoft-com:office:spreadsheet"'
+    row = ('<Row><Cell><Data>1</Data><NamedCell Name="Print_Area"/></Cell>'
+           + ''.join('<Cell><Data>{}</Data></Cell>'.format(value) 
+                     for value in ['R', 'Src', '', 'ctx', '', '']) 
+           + '</Row>')
+    test = tmp_path / "test.xml"
+    test.write_text('<Workbook {}><Worksheet><Table>{}{}</Table></Worksheet>'
+                    '</Workbook>'.format(ns, '<Row/>' * 8, row))
+    expected = ('test.xml', [['1', 'R', 'Src', 'Src', 'ctx', None, None]])
+    assert ts._parse_xml(test) == expected
+
+    # The fallback without lxml picks the same elements
+    monkeypatch.setattr(ts, 'LXML', False)
+    assert ts._parse_xml(test) == expected
+
 def test_pretranslate_row():
     row = ['ID', 'Resource', 'No glossary', None, None, None, None]
     row = ts.pretranslate_row(row)
@@ -69,6 +122,43 @@ def test_pretranslate_row():
                     'Aika to use the Sanasto', None, 
                     'glossary = sanasto; time = aika', None]
 
+    # Punctuation and multi-word glossary entries
+    row = ['ID', 'Resource', 'Press the start button, then start.', 
+            None, None, 'start = aloita; start button = aloituspainike', None]
+    row = ts.pretranslate_row(row)
+    assert row[3] == 'Press the aloituspainike, then aloita.'
+
+    # No glossary word in source
+    row = ['ID', 'Resource', 'Nothing to see here', 
+            None, None, 'glossary = sanasto', None]
+    row = ts.pretranslate_row(row)
+    assert row[3] == 'Nothing to see here'
+
+    # Empty source
+    row = ['ID', 'Resource', None, None, None, 'glossary = sanasto', None]
+    row = ts.pretranslate_row(row)
+    assert row[3] is None
+
+def test_fix_rows():
+    lines = ['1|a|<x id="1"/>|<x id = "1" />|||\n', 'no placeholders\n']
+    assert list(ts.fix_rows(lines)) == ['1|a|<x id="1"/>|<x id="1"/>|||\n', 
+                                        'no placeholders\n']
+
+def test_read_line_chunks(monkeypatch):
+    # Small chunks so lines and placeholders cross the chunk boundaries
+    texts = [
+        '1|a|<x id="1"/>|<x id = "1" />|||\r\n2|b|c|<x id = "12" />|||\r\n',
+        'no trailing newline <x id = "3" /> and <x id = "4" />',
+        'lf\n<x id = "5" />\n\ncrlf\r\n<x id = "6" />',
+        '',
+    ]
+    for chunk_size in range(1, 12):
+        monkeypatch.setattr(ts, '_CHUNK_SIZE', chunk_size)
+        for text in texts:
+            chunks = ts._read_line_chunks(StringIO(text, newline=''))
+            assert ''.join(ts.fix_rows(chunks)) == ts._BROKEN_PLACEHOLDER.sub(
+                ts._FIXED_PLACEHOLDER, text)
+
 def test_remove_systematic_errors(tmp_path: Path):
     test3 = tmp_path / "test3.csv"
     test3.write_text(Path('./test_data/test3.csv').read_text())
@@ -84,4 +174,8 @@ def test_remove_systematic_errors(tmp_path: Path):
             'For some reason <x id="1"/> and <x id="2"/> mistranslated.',
             'For some reason <x id="1"/> and <x id="2"/> mistranslated.',
             "no context", "", ""]) + "\n"
+        # Indexing not starting from 1 is also fixed
+        assert f.readline() == "|".join(["3", "Testiresurssi2", 
+            'Only <x id="2"/> here.', 'Only <x id="2"/> here.',
+            "no context", "", ""]) + "\n"
 